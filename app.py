@@ -1,133 +1,739 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
+from flask.json.provider import JSONProvider
 import os
-import json
+import re
+import orjson
+import asyncio
+import threading
+import queue
+import hashlib
+import atexit
+import secrets
+import functools
+from array import array
+from dataclasses import dataclass, field
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+class OrjsonProvider(JSONProvider):
+    """Serializes request and response bodies with orjson instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# --- Configuration ---
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Application settings, read from the environment once at import."""
+    gemini_api_key: str
+    model: str = "gemini/gemini-2.0-flash"
+    max_turns: int = 5 # User turns gathered before the report is generated
+    max_concurrent_llm_calls: int = 8 # Upper bound on concurrent Gemini requests
+    # Sampling temperature sent to Gemini; None keeps the model's default.
+    # Responses are only cached when it is set to 0.
+    llm_temperature: float | None = None
+    # The HPI step questions are asked verbatim unless this is enabled, in which
+    # case the Interviewer Agent rephrases each one for the conversation so far
+    use_llm_rephrasing: bool = False
+    semantic_question_cache: bool = False # Reuse rephrased questions by embedding similarity
+    semantic_cache_path: str | None = None # Where the semantic cache is saved, if anywhere
+    port: int = 5000
+
+    @classmethod
+    def from_env(cls):
+        def flag(name):
+            return os.environ.get(name, "false").lower() in ("1", "true", "yes")
+
+        temperature = os.environ.get("LLM_TEMPERATURE")
+        return cls(
+            gemini_api_key=os.environ.get("GEMINI_API_KEY", ""),
+            max_concurrent_llm_calls=int(os.environ.get("MAX_CONCURRENT_LLM_CALLS", 8)),
+            llm_temperature=float(temperature) if temperature else None,
+            use_llm_rephrasing=flag("USE_LLM_REPHRASING"),
+            semantic_question_cache=flag("SEMANTIC_QUESTION_CACHE"),
+            semantic_cache_path=os.environ.get("SEMANTIC_CACHE_PATH") or None,
+            port=int(os.environ.get("PORT", 5000))
+        )
+
+
+# litellm reads GEMINI_API_KEY from the environment itself; it is checked here
+# so a missing key stops the app at startup instead of on the first interview.
+CFG = Config.from_env()
+
+if not CFG.gemini_api_key:
+    raise SystemExit(
+        "ERROR: GEMINI_API_KEY environment variable is not set!\n"
+        "Please set it using: $env:GEMINI_API_KEY='your-api-key-here' (PowerShell)"
+    )
+
+# --- Lazy Imports ---
+# litellm and its dependencies are only imported once the first Gemini call is
+# made, so workers start quickly and routes like '/' never load them. numpy is
+# only needed by the semantic question cache, which is off by default.
 
-# Get API key from environment variable
-api_key = os.environ.get("GEMINI_API_KEY")
+@functools.cache
+def _litellm():
+    """Imports litellm for Gemini access."""
+    import litellm
+    litellm.set_verbose = False
+    return litellm
 
-if not api_key:
-    print("ERROR: GEMINI_API_KEY environment variable is not set!")
-    print("Please set it using: $env:GEMINI_API_KEY='your-api-key-here' (PowerShell)")
-    exit(1)
+@functools.cache
+def _numpy():
+    """Imports numpy for the semantic question cache."""
+    import numpy
+    return numpy
 
-# Set environment variable for litellm
-os.environ["GEMINI_API_KEY"] = api_key
+# --- LLM Event Loop ---
+# Flask runs every async view in its own short-lived event loop, so Gemini calls
+# are scheduled on one long-lived loop instead. This lets in-flight calls from all
+# requests share a single concurrency limit while they wait on the network.
+llm_loop = asyncio.new_event_loop()
+threading.Thread(target=llm_loop.run_forever, name="llm-loop", daemon=True).start()
+
+llm_semaphore = asyncio.Semaphore(CFG.max_concurrent_llm_calls)
+
+# --- Gemini HTTP Client ---
+@functools.cache
+def _gemini_http_client():
+    """
+    Returns the litellm HTTP handler passed to every Gemini call, so calls share
+    pooled HTTP/2 connections instead of handshaking per request. Only used from
+    llm_loop.
+    """
+    import httpx
+    from litellm.llms.custom_httpx.http_handler import AsyncHTTPHandler, get_ssl_configuration, headers
+
+    class PooledAsyncHTTPHandler(AsyncHTTPHandler):
+        """litellm HTTP handler whose httpx client speaks HTTP/2 over a bounded keep-alive pool."""
+
+        def create_client(self, timeout, event_hooks, ssl_verify=None, shared_session=None):
+            # Same SSL, client certificate and header setup as litellm's own
+            # client, with httpx's HTTP/2 pool in place of litellm's transport
+            return httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+                timeout=timeout or httpx.Timeout(timeout=600.0, connect=5.0),
+                event_hooks=event_hooks,
+                verify=get_ssl_configuration(ssl_verify),
+                cert=os.getenv("SSL_CERTIFICATE", _litellm().ssl_certificate),
+                headers=headers,
+                follow_redirects=True
+            )
+
+    return PooledAsyncHTTPHandler()
+
+# --- Interview Sessions ---
+@dataclass(slots=True)
+class Turn:
+    """One conversation turn as sent to the frontend; orjson serializes it directly."""
+    role: str
+    text: str
+
+
+@dataclass(slots=True)
+class InterviewState:
+    """
+    Conversation state of one interview. Turn roles are kept in a list while
+    turn texts live only in the prompt-ready formatted_history, with offsets
+    marking where each turn's "\n{role}: {text}" segment starts (plus a final
+    end offset). The number of user turns is kept up to date as turns are added.
+    """
+    initial_symptom: str
+    roles: list[str] = field(default_factory=list)
+    offsets: array = field(default_factory=lambda: array('i', [0]))
+    user_count: int = 0
+    is_complete: bool = False
+    formatted_history: str = ""
+    summary: str = ""
+    summarized_turns: int = 0
 
-# Import litellm for Gemini access
-import litellm
-litellm.set_verbose = False
+    def add_turn(self, role, text):
+        self.roles.append(role)
+        self.formatted_history += f"\n{role}: {text}"
+        self.offsets.append(len(self.formatted_history))
+        if role == "User":
+            self.user_count += 1
 
-# Import CrewAI
-from crewai import Agent, Task, Crew
+    def text(self, i):
+        """Returns the text of turn i (negative indexes count from the end)."""
+        i = range(len(self.roles))[i]
+        # Skip the "\n{role}: " prefix of the segment
+        start = self.offsets[i] + len(self.roles[i]) + 3
+        return self.formatted_history[start:self.offsets[i + 1]]
 
-# --- New Global State for Conversation ---
-# Stores the current interview context (questions asked, answers given)
-interview_context = {
-    "interview_id": 1,
-    "conversation_history": [],
-    "is_complete": False,
-    "initial_symptom": None
-}
+    def join_turns(self, start, stop=None):
+        """Returns turns start..stop as newline-separated "{role}: {text}" lines."""
+        stop = len(self.roles) if stop is None else stop
+        return self.formatted_history[self.offsets[start] + 1:self.offsets[stop]]
 
-# Initialize LLM
-llm = "gemini/gemini-2.0-flash"
-print("Initializing LLM:", llm)
+    def history(self):
+        """Returns the turns in the {"role", "text"} shape sent to the frontend."""
+        return [Turn(role, self.text(i)) for i, role in enumerate(self.roles)]
+
+
+# Active interviews keyed by the random interview_id handed out by
+# /start_interview, so only the client holding an id can reach its interview.
+# Sessions idle for SESSION_TTL_SECONDS are evicted so abandoned interviews do
+# not accumulate.
+SESSION_TTL_SECONDS = 1800
+sessions: TTLCache = TTLCache(maxsize=10_000, ttl=SESSION_TTL_SECONDS)
+sessions_lock = threading.Lock()
+
+def create_session(state):
+    """Stores state under a new unguessable interview_id and returns the id."""
+    with sessions_lock:
+        interview_id = secrets.token_urlsafe(16)
+        while interview_id in sessions:
+            interview_id = secrets.token_urlsafe(16)
+        sessions[interview_id] = state
+    return interview_id
+
+def get_session(interview_id):
+    """Returns the InterviewState for interview_id, or None if it is unknown or expired."""
+    if not isinstance(interview_id, str):
+        return None
+    with sessions_lock:
+        state = sessions.get(interview_id)
+        if state is not None:
+            # Re-inserting restarts the idle timer
+            sessions[interview_id] = state
+        return state
+
+print("Initializing LLM:", CFG.model)
 
 # --- Agent Definitions for Symptom Interview ---
-print("Creating Symptom Interview Agents...")
+# Each agent is a system prompt sent ahead of its task prompt.
 
 # 1. Interviewer Agent: Drives the conversation
-interviewer_agent = Agent(
-    role="Conversational Interviewer",
-    goal="Guide the user through a non-diagnostic symptom interview by asking one structured, open-ended question at a time. The interview must be structured to gather details on onset, duration, severity, and modifying factors of a symptom. Never provide a diagnosis or medical advice.",
-    backstory="You are a meticulous, empathetic medical intake specialist (non-physician) who excels at gathering detailed, relevant information about a patient's symptoms through a structured, safe conversational flow.",
-    llm=llm
+INTERVIEWER_SYSTEM_PROMPT = (
+    "Role: Conversational Interviewer\n"
+    "Goal: Guide the user through a non-diagnostic symptom interview by asking one structured, open-ended question at a time. The interview must be structured to gather details on onset, duration, severity, and modifying factors of a symptom. Never provide a diagnosis or medical advice.\n"
+    "Backstory: You are a meticulous, empathetic medical intake specialist (non-physician) who excels at gathering detailed, relevant information about a patient's symptoms through a structured, safe conversational flow."
 )
 
 # 2. Report Generator Agent: Creates the final structured report
-report_agent = Agent(
-    role="Structured Report Generator",
-    goal="Compile the full conversation history into a concise, structured non-diagnostic report for a medical professional. The report must be easy to read and only include facts gathered, not any diagnostic opinions.",
-    backstory="You are a clinical documentation expert who converts raw interview transcripts into professional, structured SOAP (Subjective, Objective, Assessment, Plan) style reports, focusing only on the Subjective and Objective parts from the user's input.",
-    llm=llm,
-    verbose=True
+REPORT_SYSTEM_PROMPT = (
+    "Role: Structured Report Generator\n"
+    "Goal: Compile the full conversation history into a concise, structured non-diagnostic report for a medical professional. The report must be easy to read and only include facts gathered, not any diagnostic opinions.\n"
+    "Backstory: You are a clinical documentation expert who converts raw interview transcripts into professional, structured SOAP (Subjective, Objective, Assessment, Plan) style reports, focusing only on the Subjective and Objective parts from the user's input."
+    """
+    
+    The report must follow this exact JSON format. Only include information explicitly mentioned in the history.
+    
+    Return ONLY the valid JSON structure without any other text or markdown:
+    {
+        "report_title": "Symptom Interview Report for [Initial Symptom]",
+        "safety_disclaimer": "This is a non-diagnostic, AI-generated intake report and is not a substitute for professional medical evaluation.",
+        "sections": [
+            {
+                "heading": "Chief Complaint",
+                "content": "Patient reports: [Initial Symptom]"
+            },
+            {
+                "heading": "History of Present Illness (HPI)",
+                "content": "Organize the patient's answers into a clear narrative covering: Onset, Location/Quality, Severity, Duration, Modifying Factors (what makes it better/worse), and Associated Symptoms."
+            },
+            {
+                "heading": "Review of Systems (ROS)",
+                "content": "List any other systems/symptoms mentioned by the patient."
+            }
+        ]
+    }
+    """
 )
-print("Symptom Interview Agents created.")
 
-def generate_report(context):
+# 3. History Summarizer Agent: Condenses older turns for the interviewer's prompts
+SUMMARY_SYSTEM_PROMPT = (
+    "Role: Interview Note Taker\n"
+    "Goal: Condense part of a symptom interview transcript into brief, factual notes that keep every detail the patient reported. Never add a diagnosis, medical advice or questions of your own.\n"
+    "Backstory: You are a careful medical scribe who keeps concise running notes of patient interviews so nothing the patient said is lost."
+)
+
+# --- Task Prompts ---
+# Filled in with str.format() per request. Everything that does not change
+# between requests, such as the report's JSON template, lives in the system
+# prompts above so it forms a static prefix.
+
+REPORT_TASK_PROMPT = """
+    Generate a structured, non-diagnostic symptom report based on the following conversation history.
+    
+    Conversation History:
+    ---
+    {full_history}
+    ---
     """
-    Kicks off the Report Generator Agent to create the final structured report.
+
+QUESTION_TASK_PROMPT = """
+    Based on the history and the initial symptom ('{initial_symptom}'), generate the next single, best follow-up question.
+    The question MUST be one of the core elements of a standard medical interview (HPI - History of Present Illness) to gather necessary details for the report.
+    
+    The next specific topic to cover is: '{next_q}'.
+    
+    Current Conversation History:
+    ---
+    {formatted_history}
+    ---
+    
+    Generate ONLY the single question text. Do NOT include a diagnosis or medical advice.
     """
-    full_history = "\n".join([f"{item['role']}: {item['text']}" for item in context["conversation_history"]])
+
+# Question prompt used with the semantic question cache: it carries only the
+# fields the cache is keyed on, so a reused question never reflects another
+# patient's earlier answers
+CACHED_QUESTION_TASK_PROMPT = """
+    A patient reported the initial symptom '{initial_symptom}'. Their latest answer was:
+    ---
+    {last_answer}
+    ---
     
-    report_task = Task(
-        description=f"""
-        Generate a structured, non-diagnostic symptom report based on the following conversation history.
-        The report must follow this exact JSON format. Only include information explicitly mentioned in the history.
-        
-        Conversation History:
-        ---
-        {full_history}
-        ---
-        
-        Return ONLY the valid JSON structure without any other text or markdown:
-        {{
-            "report_title": "Symptom Interview Report for [Initial Symptom]",
-            "safety_disclaimer": "This is a non-diagnostic, AI-generated intake report and is not a substitute for professional medical evaluation.",
-            "sections": [
-                {{
-                    "heading": "Chief Complaint",
-                    "content": "Patient reports: [Initial Symptom]"
-                }},
-                {{
-                    "heading": "History of Present Illness (HPI)",
-                    "content": "Organize the patient's answers into a clear narrative covering: Onset, Location/Quality, Severity, Duration, Modifying Factors (what makes it better/worse), and Associated Symptoms."
-                }},
-                {{
-                    "heading": "Review of Systems (ROS)",
-                    "content": "List any other systems/symptoms mentioned by the patient."
-                }}
-            ]
-        }}
-        """,
-        expected_output="Valid JSON object containing the structured, non-diagnostic symptom report.",
-        agent=report_agent
-    )
+    Generate the next single, best follow-up question. The next specific topic to cover is: '{next_q}'.
+    The question MUST be one of the core elements of a standard medical interview (HPI - History of Present Illness).
+    
+    Generate ONLY the single question text. Do NOT include a diagnosis or medical advice.
+    """
+
+SUMMARY_TASK_PROMPT = """
+    Summarize the following part of a symptom interview in a few sentences for the interviewer's notes.
+    Keep every fact the patient reported (onset, location, quality, severity, duration, modifying factors, associated symptoms).
+    Do NOT add a diagnosis or medical advice.
     
-    report_crew = Crew(agents=[report_agent], tasks=[report_task])
+    Earlier summary (may be empty):
+    ---
+    {summary}
+    ---
+    
+    Conversation:
+    ---
+    {turns}
+    ---
+    
+    Return ONLY the summary text.
+    """
+
+# Extracts the report JSON object in one pass, whether or not it is wrapped in a
+# markdown code fence
+REPORT_JSON_PATTERN = re.compile(r"```(?:json)?\s*(\{.*\})\s*```|(\{.*\})", re.S)
+
+# Message added to the history once the report is generated
+CLOSING_MESSAGE = "The interview is complete. Thank you for your patience. I have generated a structured report for review. Please find the JSON report below."
+
+# Define the structured interview flow based on standard HPI
+interview_steps = (
+    "What is the exact location, quality (e.g., sharp, dull), and severity (on a scale of 1-10) of the symptom?",
+    "When did this symptom first start, and how has it changed over time (e.g., constant, intermittent)?",
+    "What makes the symptom better, and what makes it worse?",
+    "Are you experiencing any other related symptoms, even minor ones?"
+)
+
+# --- LLM Response Cache ---
+# Exact-match cache of deterministic (CFG.llm_temperature 0) completions, keyed
+# by a SHA-256 of the model and full prompt. Only touched from llm_loop.
+llm_cache = TTLCache(maxsize=4096, ttl=3600)
+llm_cache_stats = {"hits": 0, "misses": 0}
+
+def llm_cache_key(system_prompt, prompt):
+    """Returns the cache key for a prompt sent to the configured model."""
+    payload = orjson.dumps({"m": CFG.model, "s": system_prompt, "p": prompt}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+async def _gemini_acompletion(system_prompt, prompt, **kwargs):
+    """Calls litellm.acompletion for a prompt on the pooled client. Must run on llm_loop."""
+    if CFG.llm_temperature is not None:
+        kwargs["temperature"] = CFG.llm_temperature
+    return await _litellm().acompletion(
+        model=CFG.model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ],
+        client=_gemini_http_client(),
+        **kwargs
+    )
+
+
+async def _send_completion(system_prompt, prompt):
+    """Sends one chat completion to Gemini and returns its text. Must run on llm_loop."""
+    async with llm_semaphore:
+        response = await _gemini_acompletion(system_prompt, prompt)
+    return response.choices[0].message.content.strip()
+
+
+async def _acompletion(system_prompt, prompt):
+    """Gets one chat completion from Gemini, or serves it from llm_cache. Must run on llm_loop."""
+    cacheable = CFG.llm_temperature == 0
+    if cacheable:
+        key = llm_cache_key(system_prompt, prompt)
+        cached = llm_cache.get(key)
+        if cached is not None:
+            llm_cache_stats["hits"] += 1
+            return cached
+        llm_cache_stats["misses"] += 1
+
+    text = await _send_completion(system_prompt, prompt)
+
+    if cacheable:
+        llm_cache[key] = text
+    return text
+
+
+async def _astream_completion(system_prompt, prompt, emit):
+    """
+    Streams one chat completion from Gemini, passing each text delta to emit,
+    and returns the full text. llm_cache hits are emitted as a single delta.
+    Must run on llm_loop.
+    """
+    cacheable = CFG.llm_temperature == 0
+    if cacheable:
+        key = llm_cache_key(system_prompt, prompt)
+        cached = llm_cache.get(key)
+        if cached is not None:
+            llm_cache_stats["hits"] += 1
+            emit(cached)
+            return cached
+        llm_cache_stats["misses"] += 1
+
+    parts = []
+    async with llm_semaphore:
+        response = await _gemini_acompletion(system_prompt, prompt, stream=True)
+        async for chunk in response:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                emit(delta)
+    text = "".join(parts).strip()
+
+    if cacheable:
+        llm_cache[key] = text
+    return text
+
+
+def _completion(system_prompt, prompt, emit=None):
+    """Returns the completion coroutine to run, streamed when emit is given."""
+    if emit is None:
+        return _acompletion(system_prompt, prompt)
+    return _astream_completion(system_prompt, prompt, emit)
+
+
+# --- Semantic Question Cache ---
+# Follow-up questions are nearly canonical for a given interview step, so when
+# CFG.semantic_question_cache is enabled, rephrased questions are generated from
+# CACHED_QUESTION_TASK_PROMPT alone and reused when the embedding of (initial
+# symptom, last answer) is close enough to one already seen at the same step.
+# The cache is only written to disk if CFG.semantic_cache_path is set.
+EMBEDDING_MODEL = "gemini/text-embedding-004"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAXSIZE = 10_000
+
+class SemanticQuestionCache:
+    """
+    Per-step cosine-similarity lookup over normalized embeddings of one model,
+    evicting the least recently used entry once maxsize is reached. Only touched
+    from llm_loop (and at exit).
+    """
+
+    def __init__(self, model, threshold, maxsize):
+        self.model = model
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.dim = None  # Embedding size, set by the first vector stored or loaded
+        self.steps = {}  # step -> {"vectors": (n, dim) array, "questions": [...], "used": [...]}
+        self.size = 0
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _check_dim(self, vector):
+        """Drops every entry if vector's size differs from the stored embeddings'."""
+        if self.dim is not None and vector.shape[0] != self.dim:
+            print(f"Embedding size changed from {self.dim} to {vector.shape[0]}, clearing semantic cache")
+            self.steps.clear()
+            self.size = 0
+        self.dim = vector.shape[0]
+
+    def lookup(self, step, vector):
+        """Returns the cached question closest to vector, or None below the threshold."""
+        self._check_dim(vector)
+        index = self.steps.get(step)
+        if index is not None and index["questions"]:
+            scores = index["vectors"] @ vector
+            best = int(scores.argmax())
+            if scores[best] >= self.threshold:
+                self.clock += 1
+                index["used"][best] = self.clock
+                self.hits += 1
+                return index["questions"][best]
+        self.misses += 1
+        return None
+
+    def insert(self, step, vector, question):
+        np = _numpy()
+        self._check_dim(vector)
+        if self.size >= self.maxsize:
+            self._evict()
+        index = self.steps.setdefault(step, {
+            "vectors": np.empty((0, vector.shape[0]), dtype=np.float32),
+            "questions": [],
+            "used": []
+        })
+        self.clock += 1
+        index["vectors"] = np.vstack([index["vectors"], vector])
+        index["questions"].append(question)
+        index["used"].append(self.clock)
+        self.size += 1
+
+    def _evict(self):
+        """Drops the least recently used entry across all steps."""
+        np = _numpy()
+        oldest = None
+        for step, index in self.steps.items():
+            for row, used in enumerate(index["used"]):
+                if oldest is None or used < oldest[0]:
+                    oldest = (used, step, row)
+        _, step, row = oldest
+        index = self.steps[step]
+        index["vectors"] = np.delete(index["vectors"], row, axis=0)
+        del index["questions"][row]
+        del index["used"][row]
+        self.size -= 1
+
+    def save(self, path):
+        """Writes the cache to path through a temporary file, so readers never see a partial file."""
+        np = _numpy()
+        arrays = {"model": np.array(self.model), "dim": np.array(self.dim or 0)}
+        for step, index in self.steps.items():
+            arrays[f"vectors_{step}"] = index["vectors"]
+            arrays[f"questions_{step}"] = np.array(index["questions"], dtype=str)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """Loads a saved cache, unless it was built with a different embedding model."""
+        np = _numpy()
+        with np.load(path) as data:
+            if "model" not in data.files or str(data["model"]) != self.model:
+                print(f"Ignoring semantic cache {path}: not built with {self.model}")
+                return
+            self.dim = int(data["dim"]) or None
+            for name in data.files:
+                if not name.startswith("vectors_"):
+                    continue
+                step = int(name.removeprefix("vectors_"))
+                questions = [str(q) for q in data[f"questions_{step}"]]
+                self.steps[step] = {
+                    "vectors": data[name],
+                    "questions": questions,
+                    "used": [0] * len(questions)
+                }
+                self.size += len(questions)
+
+semantic_cache = SemanticQuestionCache(EMBEDDING_MODEL, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAXSIZE)
+if CFG.use_llm_rephrasing and CFG.semantic_question_cache and CFG.semantic_cache_path:
+    if os.path.exists(CFG.semantic_cache_path):
+        try:
+            semantic_cache.load(CFG.semantic_cache_path)
+            print(f"Loaded {semantic_cache.size} cached questions from {CFG.semantic_cache_path}")
+        except Exception as e:
+            print(f"Error loading semantic cache: {e}")
+    atexit.register(semantic_cache.save, CFG.semantic_cache_path)
+
+
+async def _aembed(text):
+    """Returns the normalized embedding of text. Must run on llm_loop."""
+    np = _numpy()
+    async with llm_semaphore:
+        response = await _litellm().aembedding(
+            model=EMBEDDING_MODEL,
+            input=[text],
+            client=_gemini_http_client()
+        )
+    vector = np.asarray(response.data[0]["embedding"], dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+async def _acached_question(step, initial_symptom, last_answer, next_q, emit=None):
+    """
+    Serves the follow-up question for step from semantic_cache, or generates
+    and stores it. Must run on llm_loop.
+    """
+    prompt = CACHED_QUESTION_TASK_PROMPT.format(
+        initial_symptom=initial_symptom,
+        last_answer=last_answer,
+        next_q=next_q
+    )
+    try:
+        vector = await _aembed(f"{initial_symptom}\n{last_answer}")
+        question = semantic_cache.lookup(step, vector)
+    except Exception as e:
+        print(f"Error looking up cached question: {e}")
+        return await _completion(INTERVIEWER_SYSTEM_PROMPT, prompt, emit)
+
+    if question is None:
+        question = await _completion(INTERVIEWER_SYSTEM_PROMPT, prompt, emit)
+        try:
+            semantic_cache.insert(step, vector, question)
+        except Exception as e:
+            print(f"Error caching question: {e}")
+    elif emit is not None:
+        emit(question)
+    return question
+
+
+async def run_on_llm_loop(coro):
+    """
+    Runs coro on the shared LLM loop and awaits its result from the calling
+    request's loop. Code already running on llm_loop awaits it directly.
+    """
+    if asyncio.get_running_loop() is llm_loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, llm_loop))
+
+
+async def call_llm(system_prompt, prompt, emit=None):
+    """
+    Runs a Gemini completion on the shared LLM loop and returns its text.
+    If emit is given, the completion is streamed and each delta passed to it.
+    """
+    return await run_on_llm_loop(_completion(system_prompt, prompt, emit))
+
+
+async def generate_report(state, emit=None):
+    """
+    Asks the Report Generator Agent to create the final structured report.
+    """
     try:
-        report_result = report_crew.kickoff()
-        # Clean up result if it's wrapped in markdown
-        report_text = str(report_result).strip()
-        if report_text.startswith('```') and report_text.endswith('```'):
-            report_text = report_text.split('\n', 1)[1].rsplit('\n', 1)[0].strip()
-        return json.loads(report_text)
+        report_text = await call_llm(
+            REPORT_SYSTEM_PROMPT,
+            REPORT_TASK_PROMPT.format(full_history=state.formatted_history),
+            emit
+        )
+        match = REPORT_JSON_PATTERN.search(report_text)
+        if match is None:
+            raise ValueError("no JSON object found in the report output")
+        return orjson.loads(match.group(1) or match.group(2))
     except Exception as e:
         print(f"Error generating report: {e}")
         return {"error": f"Failed to generate structured report: {str(e)}"}
 
 
-def get_next_question(history, initial_symptom):
+# --- Prompt History Budget ---
+# Interviewer prompts carry the transcript verbatim until the whole prompt
+# exceeds PROMPT_TOKEN_BUDGET; older turns are then folded into a running
+# summary and only the last HISTORY_RECENT_TURNS turns are kept word for word.
+PROMPT_TOKEN_BUDGET = 1500
+HISTORY_RECENT_TURNS = 6
+
+# Loading the encoding may download it and encoding is CPU work, so token
+# counting runs in llm_loop's executor rather than on the loop itself.
+_history_encoding_lock = threading.Lock()
+
+@functools.cache
+def _load_history_encoding():
+    """Returns the cl100k_base encoding, or None if it could not be loaded; failures are not retried."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"Error loading tokenizer, sending full transcripts: {e}")
+        return None
+
+def _history_encoding():
+    with _history_encoding_lock:
+        return _load_history_encoding()
+
+def count_tokens(text):
+    return len(_history_encoding().encode(text, disallowed_special=()))
+
+
+@functools.cache
+def _static_prompt_tokens():
     """
-    Kicks off the Interviewer Agent to generate the next question.
+    Token count of the fixed text of an interviewer prompt (system prompt and
+    question template), tokenized once so each turn only encodes the transcript.
+    Only called from the executor once the encoding has loaded.
     """
-    formatted_history = "\n".join([f"{item['role']}: {item['text']}" for item in history])
+    template = QUESTION_TASK_PROMPT.format(formatted_history="", next_q="", initial_symptom="")
+    return count_tokens(INTERVIEWER_SYSTEM_PROMPT) + count_tokens(template)
+
+
+def _history_over_budget(summary, recent):
+    """
+    Returns whether summary and recent turns exceed the history's share of the
+    budget, or None if the tokenizer is unavailable. Blocks, so it runs in an
+    executor.
+    """
+    if _history_encoding() is None:
+        return None
+    history_budget = PROMPT_TOKEN_BUDGET - _static_prompt_tokens()
+    return count_tokens(summary) + count_tokens(recent) > history_budget
+
+
+def _warm_prompt_budget():
+    """Loads the encoding and counts the static prompt tokens ahead of the first interview."""
+    if _history_encoding() is not None:
+        _static_prompt_tokens()
+
+
+# Interviewer prompts only carry the transcript when rephrasing without the
+# semantic question cache, so only then is the tokenizer loaded at startup
+if CFG.use_llm_rephrasing and not CFG.semantic_question_cache:
+    llm_loop.call_soon_threadsafe(llm_loop.run_in_executor, None, _warm_prompt_budget)
+
+
+async def prompt_history(state):
+    """
+    Returns the transcript to send in interviewer prompts, summarizing older
+    turns once the verbatim part no longer fits the token budget.
+    """
+    recent = state.join_turns(state.summarized_turns)
+    cutoff = len(state.roles) - HISTORY_RECENT_TURNS
+    try:
+        over_budget = await asyncio.get_running_loop().run_in_executor(
+            None, _history_over_budget, state.summary, recent
+        )
+    except Exception as e:
+        print(f"Error counting history tokens: {e}")
+        over_budget = None
+    if over_budget is None:
+        return state.formatted_history
     
-    # Define the structured interview flow based on standard HPI
-    interview_steps = [
-        "What is the exact location, quality (e.g., sharp, dull), and severity (on a scale of 1-10) of the symptom?",
-        "When did this symptom first start, and how has it changed over time (e.g., constant, intermittent)?",
-        "What makes the symptom better, and what makes it worse?",
-        "Are you experiencing any other related symptoms, even minor ones?"
-    ]
+    if over_budget and cutoff > state.summarized_turns:
+        try:
+            state.summary = await call_llm(
+                SUMMARY_SYSTEM_PROMPT,
+                SUMMARY_TASK_PROMPT.format(
+                    summary=state.summary,
+                    turns=state.join_turns(state.summarized_turns, cutoff)
+                )
+            )
+        except Exception as e:
+            print(f"Error summarizing history: {e}")
+            return state.formatted_history
+        state.summarized_turns = cutoff
+        recent = state.join_turns(cutoff)
     
-    current_step = len([item for item in history if item['role'] == 'User'])
+    if state.summary:
+        return f"Summary of earlier conversation: {state.summary}\n{recent}"
+    return recent
+
+
+async def get_next_question(state, emit=None):
+    """
+    Asks the Interviewer Agent to generate the next question.
+    """
+    current_step = state.user_count
     
     if current_step == 0:
         # Initial question already asked, this is the first real follow-up
@@ -138,32 +744,99 @@ def get_next_question(history, initial_symptom):
     else:
         # Final, open-ended follow-up before reporting
         return "Is there anything else you think is important for a doctor to know about this symptom or your overall health right now?"
+    
+    if not CFG.use_llm_rephrasing:
+        return next_q
         
-    question_task = Task(
-        description=f"""
-        Based on the history and the initial symptom ('{initial_symptom}'), generate the next single, best follow-up question.
-        The question MUST be one of the core elements of a standard medical interview (HPI - History of Present Illness) to gather necessary details for the report.
+    try:
+        if CFG.semantic_question_cache:
+            # The user's answer is always the latest turn when a question is requested
+            return await run_on_llm_loop(
+                _acached_question(current_step, state.initial_symptom, state.text(-1), next_q, emit)
+            )
+        prompt = QUESTION_TASK_PROMPT.format(
+            formatted_history=await prompt_history(state),
+            next_q=next_q,
+            initial_symptom=state.initial_symptom
+        )
+        return await call_llm(INTERVIEWER_SYSTEM_PROMPT, prompt, emit)
+    except Exception as e:
+        print(f"Error generating question: {e}")
+        return "I apologize, an error occurred. Can you please summarize your symptoms one more time?"
+
+
+async def advance_interview(state, emit=None):
+    """
+    Produces the agent's reply to the user's latest answer: the next question,
+    or the report and closing message once enough details have been gathered.
+    If emit is given, it receives {'delta': ...} events for a streamed question
+    and {'report_delta': ...} events for a streamed report.
+    """
+    question_emit = report_emit = None
+    if emit is not None:
+        question_emit = lambda delta: emit({'delta': delta})
+        report_emit = lambda delta: emit({'report_delta': delta})
+    
+    # Check if the interview is ready for reporting (based on number of turns)
+    if state.user_count >= CFG.max_turns:
+        state.is_complete = True
         
-        The next specific topic to cover is: '{next_q}'.
+        report = await generate_report(state, report_emit)
         
-        Current Conversation History:
-        ---
-        {formatted_history}
-        ---
+        state.add_turn("System", CLOSING_MESSAGE)
         
-        Generate ONLY the single question text. Do NOT include a diagnosis or medical advice.
-        """,
-        expected_output="A single, non-diagnostic follow-up question.",
-        agent=interviewer_agent
-    )
+        return {
+            'next_question': None, # Signal to frontend that conversation is over
+            'is_complete': True,
+            'structured_report': report,
+            'history': state.history()
+        }
+    
+    # Generate the next question
+    next_question = await get_next_question(state, question_emit)
+    
+    # Append agent's question to history
+    state.add_turn("Agent", next_question)
+    
+    return {
+        'next_question': next_question,
+        'is_complete': False,
+        'history': state.history()
+    }
+
+
+def json_response(payload):
+    """
+    Serializes payload with orjson in a single pass, dataclasses included, and
+    returns it as a raw JSON response without going through jsonify.
+    """
+    return Response(orjson.dumps(payload, option=orjson.OPT_APPEND_NEWLINE), mimetype="application/json")
+
+
+def sse_event(data):
+    """Formats data as one Server-Sent Events message."""
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+
+def stream_interview_turn(state, interview_id):
+    """
+    Runs advance_interview on the LLM loop and yields its streamed deltas as
+    Server-Sent Events, followed by the same payload the JSON response carries.
+    """
+    events = queue.Queue()
+    turn = asyncio.run_coroutine_threadsafe(advance_interview(state, events.put), llm_loop)
+    turn.add_done_callback(lambda _: events.put(None))
+    
+    while (event := events.get()) is not None:
+        yield sse_event(event)
     
-    interview_crew = Crew(agents=[interviewer_agent], tasks=[question_task])
     try:
-        question_result = interview_crew.kickoff()
-        return str(question_result).strip()
+        yield sse_event({'interview_id': interview_id, **turn.result()})
     except Exception as e:
-        print(f"Error generating question: {e}")
-        return "I apologize, an error occurred. Can you please summarize your symptoms one more time?"
+        print(f"Error continuing interview: {e}")
+        # Reset the interview on major error
+        state.is_complete = True
+        yield sse_event({'error': f'An unexpected error occurred during the interview process: {str(e)}'})
 
 # --- Flask Routes ---
 
@@ -173,9 +846,8 @@ def index():
     return render_template('index.html')
 
 @app.route('/start_interview', methods=['POST'])
-def start_interview():
+async def start_interview():
     """Starts a new interview session."""
-    global interview_context
     print("Starting new interview...")
     
     try:
@@ -185,117 +857,114 @@ def start_interview():
         if not initial_symptom:
             return jsonify({'error': 'Please provide an initial symptom to start the interview.'}), 400
         
-        # Reset and initialize context
-        interview_context = {
-            "interview_id": interview_context['interview_id'] + 1,
-            "conversation_history": [
-                {"role": "User", "text": initial_symptom}
-            ],
-            "is_complete": False,
-            "initial_symptom": initial_symptom
-        }
+        # Initialize a fresh session for this interview
+        state = InterviewState(initial_symptom=initial_symptom)
+        state.add_turn("User", initial_symptom)
         
         # Initial response from the system
         initial_question = f"Thank you for sharing your symptom: '{initial_symptom}'. To begin, can you tell me when you first noticed this symptom?"
         
-        interview_context["conversation_history"].append({
-            "role": "Agent",
-            "text": initial_question
-        })
+        state.add_turn("Agent", initial_question)
+        
+        interview_id = create_session(state)
         
-        print("Interview started successfully.")
-        return jsonify({
-            'interview_id': interview_context['interview_id'],
+        print(f"Interview {interview_id} started successfully.")
+        return json_response({
+            'interview_id': interview_id,
             'initial_question': initial_question,
-            'history': interview_context['conversation_history']
+            'history': state.history()
         })
     except Exception as e:
         print(f"Error starting interview: {e}")
         return jsonify({'error': f'An unexpected error occurred: {str(e)}'}), 500
 
 @app.route('/continue_interview', methods=['POST'])
-def continue_interview():
+async def continue_interview():
     """Handles user response and generates the next question."""
-    global interview_context
-    print(f"Continuing interview {interview_context['interview_id']}...")
+    state = None
     
     try:
-        if interview_context["is_complete"]:
+        data = request.get_json()
+        interview_id = data.get('interview_id')
+        
+        if not isinstance(interview_id, str) or not interview_id:
+            return jsonify({'error': 'Please provide a valid interview_id.'}), 400
+        
+        state = get_session(interview_id)
+        
+        if state is None:
+            return jsonify({'error': 'Interview not found. Please start a new one.'}), 404
+        
+        print(f"Continuing interview {interview_id}...")
+        
+        if state.is_complete:
             return jsonify({'error': 'Interview is already complete. Please start a new one.'}), 400
             
-        data = request.get_json()
         user_response = data.get('user_response', '').strip()
         
         if not user_response:
             return jsonify({'error': 'Please provide a response to continue.'}), 400
         
         # Append user's response to history
-        interview_context["conversation_history"].append({
-            "role": "User",
-            "text": user_response
-        })
-        
-        # Check if the interview is ready for reporting (based on number of turns)
-        user_turn_count = len([item for item in interview_context["conversation_history"] if item['role'] == 'User'])
+        state.add_turn("User", user_response)
         
-        if user_turn_count >= 5: # A good conversational length to gather enough details
-            interview_context["is_complete"] = True
-            
-            # Kick off the Report Generator
-            report = generate_report(interview_context)
-            
-            interview_context["conversation_history"].append({
-                "role": "System",
-                "text": "The interview is complete. Thank you for your patience. I have generated a structured report for review. Please find the JSON report below."
-            })
-            
-            return jsonify({
-                'interview_id': interview_context['interview_id'],
-                'next_question': None, # Signal to frontend that conversation is over
-                'is_complete': True,
-                'structured_report': report,
-                'history': interview_context['conversation_history']
-            })
-        
-        # Generate the next question
-        next_question = get_next_question(
-            interview_context["conversation_history"], 
-            interview_context["initial_symptom"]
-        )
-        
-        # Append agent's question to history
-        interview_context["conversation_history"].append({
-            "role": "Agent",
-            "text": next_question
-        })
+        # Stream the reply as it is generated when the client asks for it
+        if 'text/event-stream' in request.headers.get('Accept', ''):
+            return Response(
+                stream_interview_turn(state, interview_id),
+                mimetype='text/event-stream',
+                # Keep proxies from caching or buffering the stream until it ends
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
         
-        return jsonify({
-            'interview_id': interview_context['interview_id'],
-            'next_question': next_question,
-            'is_complete': False,
-            'history': interview_context['conversation_history']
-        })
+        # The whole turn runs as one task on the LLM loop, interleaved with every
+        # other interview's turn while it waits on Gemini
+        return json_response({'interview_id': interview_id, **await run_on_llm_loop(advance_interview(state))})
         
     except Exception as e:
         print(f"Error continuing interview: {e}")
         # Reset the interview on major error
-        interview_context["is_complete"] = True 
+        if state is not None:
+            state.is_complete = True 
         return jsonify({'error': f'An unexpected error occurred during the interview process: {str(e)}'}), 500
 
 @app.route('/get_report', methods=['GET'])
-def get_report():
+async def get_report():
     """Retrieves the final structured report if the interview is complete."""
-    global interview_context
-    if not interview_context["is_complete"]:
+    state = get_session(request.args.get('interview_id', ''))
+    if state is None:
+        return jsonify({'error': 'Interview not found. Please start a new one.'}), 404
+    if not state.is_complete:
         return jsonify({'error': 'Interview is not yet complete. Cannot generate report.'}), 400
     
     # Regenerate the report if not yet generated or if directly requested
-    report = generate_report(interview_context)
-    return jsonify(report)
+    report = await run_on_llm_loop(generate_report(state))
+    return json_response(report)
+
+async def cache_metrics():
+    """Snapshots the cache counters. Must run on llm_loop, which owns both caches."""
+    return {
+        'llm_cache': {
+            'hits': llm_cache_stats['hits'],
+            'misses': llm_cache_stats['misses'],
+            'size': len(llm_cache)
+        },
+        'semantic_cache': {
+            'hits': semantic_cache.hits,
+            'misses': semantic_cache.misses,
+            'size': semantic_cache.size
+        }
+    }
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    """Reports LLM response and semantic question cache counters."""
+    # Read on llm_loop, since len() on a TTLCache also expires entries
+    return jsonify(await run_on_llm_loop(cache_metrics()))
 
 
 if __name__ == '__main__':
     print("Starting Flask app...")
-    port = int(os.environ.get('PORT', 5000))
     # Note: debug=True is okay for local development, but use a proper WSGI server (like gunicorn) for production.
-    app.run(host='0.0.0.0', port=port, debug=True, use_reloader=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=CFG.port, debug=True, use_reloader=False)
\ No newline at end of file
@@ -11,6 +11,7 @@ document.addEventListener("DOMContentLoaded", () => {
 
     let isInterviewActive = false;
     let isRequestPending = false;
+    let interviewId = null;
 
     // --- Utility Functions ---
 
@@ -18,6 +19,7 @@ document.addEventListener("DOMContentLoaded", () => {
      * Appends a message to the chat history.
      * @param {string} role - 'User' or 'Agent'
      * @param {string} text - The message content
+     * @returns {HTMLParagraphElement} The element holding the message text
      */
     function appendMessage(role, text) {
         const messageDiv = document.createElement("div");
@@ -36,6 +38,58 @@ document.addEventListener("DOMContentLoaded", () => {
 
         // Auto-scroll to the latest message
         chatHistory.scrollTop = chatHistory.scrollHeight;
+
+        return contentP;
+    }
+
+    /**
+     * Reads a Server-Sent Events interview response, showing streamed text as it arrives.
+     * @param {Response} response - The fetch response with a text/event-stream body
+     * @returns {Promise<{data: Object, questionElement: ?HTMLParagraphElement}>} The final
+     *     turn payload and the chat element the question was streamed into, if any.
+     */
+    async function readInterviewStream(response) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let data = null;
+        let questionElement = null;
+        let questionText = "";
+        let reportText = "";
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let boundary;
+            while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                if (!rawEvent.startsWith("data: ")) continue;
+
+                const event = JSON.parse(rawEvent.slice(6));
+                if (event.delta !== undefined) {
+                    questionText += event.delta;
+                    if (!questionElement) {
+                        questionElement = appendMessage("Agent", "");
+                    }
+                    questionElement.innerHTML = questionText.replace(/\n/g, "<br>");
+                    chatHistory.scrollTop = chatHistory.scrollHeight;
+                } else if (event.report_delta !== undefined) {
+                    reportText += event.report_delta;
+                    structuredReportDisplay.textContent = reportText;
+                    reportContainer.style.display = 'block';
+                } else {
+                    data = event;
+                }
+            }
+        }
+
+        if (!data) {
+            throw new Error("The response stream ended unexpectedly.");
+        }
+        return { data, questionElement };
     }
 
     /**
@@ -70,13 +124,17 @@ document.addEventListener("DOMContentLoaded", () => {
 
         const endpoint = isInterviewActive ? '/continue_interview' : '/start_interview';
         const payload = isInterviewActive 
-            ? { user_response: text }
+            ? { user_response: text, interview_id: interviewId }
             : { initial_symptom: text };
         
         try {
             const response = await fetch(endpoint, {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: {
+                    'Content-Type': 'application/json',
+                    // Follow-up turns are streamed as Server-Sent Events
+                    'Accept': isInterviewActive ? 'text/event-stream' : 'application/json'
+                },
                 body: JSON.stringify(payload)
             });
 
@@ -85,7 +143,13 @@ document.addEventListener("DOMContentLoaded", () => {
                 throw new Error(errorData.error || `HTTP error! Status: ${response.status}`);
             }
 
-            const data = await response.json();
+            let data;
+            let questionElement = null;
+            if ((response.headers.get('Content-Type') || '').startsWith('text/event-stream')) {
+                ({ data, questionElement } = await readInterviewStream(response));
+            } else {
+                data = await response.json();
+            }
             
             if (data.error) {
                 throw new Error(data.error);
@@ -94,6 +158,7 @@ document.addEventListener("DOMContentLoaded", () => {
             if (!isInterviewActive) {
                 // Initial response
                 isInterviewActive = true;
+                interviewId = data.interview_id;
                 userInput.placeholder = "Enter your response here...";
             }
 
@@ -115,8 +180,12 @@ document.addEventListener("DOMContentLoaded", () => {
                 reportContainer.style.display = 'block';
 
             } else {
-                // Continue interview, append agent's question
-                appendMessage("Agent", data.next_question);
+                // Continue interview, append agent's question (or finalize the streamed one)
+                if (questionElement) {
+                    questionElement.innerHTML = data.next_question.replace(/\n/g, "<br>");
+                } else {
+                    appendMessage("Agent", data.next_question);
+                }
             }
 
         } catch (error) {